@@ -10,60 +10,147 @@ problem into small, sequential steps that the 'flash' model can handle.
 import os
 import re
 import io
+import json
+import hashlib
+import functools
+from collections import OrderedDict
 from datetime import datetime
-from typing import Dict, Any, List, Optional
+from typing import AsyncGenerator, Dict, Any, List, Optional, Tuple
 from dotenv import load_dotenv
-from google.adk.agents import Agent, SequentialAgent
+from google.adk.agents import Agent, BaseAgent, ParallelAgent, SequentialAgent
+from google.adk.agents.callback_context import CallbackContext
+from google.adk.agents.invocation_context import InvocationContext
+from google.adk.agents.readonly_context import ReadonlyContext
+from google.adk.events import Event, EventActions
+from google.adk.models import LlmRequest, LlmResponse
 from google.adk.tools import ToolContext
-from pypdf import PdfReader
+from google.genai import types
 
-# Load environment variables
-load_dotenv()
+# Load environment variables (set ADK_SKIP_DOTENV when they are already exported)
+if not os.getenv("ADK_SKIP_DOTENV"):
+    load_dotenv()
+
+# Set DISABLE_CACHE to always re-extract PDFs and re-run the analysis models
+CACHE_ENABLED = not os.getenv("DISABLE_CACHE")
+
+
+def _remember(cache: OrderedDict, key: Any, value: Any, max_size: int) -> None:
+    """Stores a value in an LRU-ordered cache, evicting the oldest entries."""
+    cache[key] = value
+    cache.move_to_end(key)
+    while len(cache) > max_size:
+        cache.popitem(last=False)
 
 
 # ============================================================================
 # PDF PROCESSING UTILITIES 
+# PDF libraries are imported on first use so text-only sessions never load them.
 # ============================================================================
 
+PDF_ERROR_PREFIX = "Error extracting PDF:"
+
+# An uploaded PDF stays in the session's artifacts, so every later turn would
+# otherwise parse the same file again.
+PDF_CACHE_SIZE = 16
+_pdf_text_cache: "OrderedDict[str, str]" = OrderedDict()
+
+
+@functools.lru_cache(maxsize=1)
+def _load_pdfium():
+    """Returns the optional pypdfium2 module, or None when it is not installed."""
+    try:
+        import pypdfium2 as pdfium
+    except ImportError:  # Optional native backend; pypdf is used when missing
+        return None
+    return pdfium
+
+
+def _extract_text_with_pdfium(pdfium, pdf_content: bytes) -> str:
+    """Extracts text using the native PDFium backend (much faster than pypdf)."""
+    # Raw bytes are loaded straight from memory; a file object would be read
+    # back through Python callbacks block by block.
+    pdf = pdfium.PdfDocument(pdf_content)
+    try:
+        page_texts = (page.get_textpage().get_text_range() for page in pdf)
+        return "\n".join(filter(None, page_texts)).strip()
+    finally:
+        pdf.close()
+
+
 def extract_text_from_pdf(pdf_content: bytes) -> str:
-    """Extracts text from PDF file content."""
+    """Extracts text from PDF file content, reusing earlier results for the same file."""
+    key = hashlib.sha256(pdf_content).hexdigest() if CACHE_ENABLED else None
+    if key in _pdf_text_cache:
+        _pdf_text_cache.move_to_end(key)
+        return _pdf_text_cache[key]
+    text = _read_pdf_text(pdf_content)
+    if key and not text.startswith(PDF_ERROR_PREFIX):
+        _remember(_pdf_text_cache, key, text, PDF_CACHE_SIZE)
+    return text
+
+
+def _read_pdf_text(pdf_content: bytes) -> str:
     try:
+        pdfium = _load_pdfium()
+        if pdfium is not None:
+            return _extract_text_with_pdfium(pdfium, pdf_content)
+        from pypdf import PdfReader
         pdf_file = io.BytesIO(pdf_content)
         pdf_reader = PdfReader(pdf_file)
-        text = ""
-        for page in pdf_reader.pages:
-            page_text = page.extract_text()
-            if page_text:
-                text += page_text + "\n"
-        return text.strip()
+        page_texts = (page.extract_text() for page in pdf_reader.pages)
+        return "\n".join(filter(None, page_texts)).strip()
     except Exception as e:
-        return f"Error extracting PDF: {str(e)}"
+        return f"{PDF_ERROR_PREFIX} {str(e)}"
 
 
 # ============================================================================
 # DOCUMENT EXTRACTOR TOOL 
 # ============================================================================
 
+# Control characters are deleted in one str.translate pass. Tabs and newlines
+# are kept so the whitespace patterns below can collapse them.
+_CONTROL_CHARS = dict.fromkeys(
+    [c for c in range(0x00, 0x20) if c not in (0x09, 0x0a)] + list(range(0x7f, 0xa0))
+)
+_SPACES_RE = re.compile(r'[ \t]+')
+_NEWLINES_RE = re.compile(r'\n+')
+
+# Cleared on every extraction so a failed or empty analyst answer can never
+# leave the previous document's results in the new report.
+_ANALYSIS_RESULT_KEYS = ("analysis_result", "party_result", "financial_result", "risk_result")
+
+
+def _reset_analysis_results(tool_context: ToolContext) -> None:
+    for key in _ANALYSIS_RESULT_KEYS:
+        tool_context.state[key] = None
+
+
 def extract_document_text(document_text: Optional[str] = None, tool_context: Optional[ToolContext] = None) -> Dict[str, Any]:
     """Extracts and cleans text from a legal document (text or PDF format)."""
     extracted_text = ""
     source_type = "text"
+    pdf_error = None
     
     if tool_context:
         try:
             artifacts = tool_context.list_artifacts()
-            pdf_files = [f for f in artifacts if f.lower().endswith('.pdf')]
+            pdf_filename = next((f for f in artifacts if f.lower().endswith('.pdf')), None)
             
-            if pdf_files:
-                pdf_filename = pdf_files[0]
+            if pdf_filename:
                 print(f"Processing PDF file: {pdf_filename}")
                 pdf_artifact = tool_context.load_artifact(pdf_filename)
                 
                 if pdf_artifact and hasattr(pdf_artifact, 'inline_data'):
                     pdf_bytes = pdf_artifact.inline_data.data
                     extracted_text = extract_text_from_pdf(pdf_bytes)
-                    source_type = "pdf"
-                    print(f"Extracted {len(extracted_text)} characters from PDF")
+                    if extracted_text.startswith(PDF_ERROR_PREFIX):
+                        # Never analyze the error message as if it were the document
+                        pdf_error = extracted_text
+                        extracted_text = ""
+                        print(pdf_error)
+                    else:
+                        source_type = "pdf"
+                        print(f"Extracted {len(extracted_text)} characters from PDF")
         except Exception as e:
             print(f"Error processing PDF: {str(e)}")
             pass
@@ -72,32 +159,270 @@ def extract_document_text(document_text: Optional[str] = None, tool_context: Opt
         extracted_text = document_text
         source_type = "text"
     
-    if not extracted_text or len(extracted_text.strip()) < 50:
+    # Validate before cleaning so empty or failed documents skip the cleanup passes
+    stripped = extracted_text.strip() if extracted_text else ""
+    if len(stripped) < 50:
+        message = pdf_error or "Document text is too short or empty. Please provide a valid legal document (text or PDF)."
+        if tool_context:
+            tool_context.state["document_hash"] = None
+            tool_context.state["cleaned_text"] = ""
+            tool_context.state["analysis_date"] = None
+            tool_context.state["extraction_error"] = message
+            _reset_analysis_results(tool_context)
         return {
             "status": "error",
-            "message": "Document text is too short or empty. Please provide a valid legal document (text or PDF).",
-            "cleaned_text": "",
+            "message": message,
         }
     
-    cleaned = extracted_text.strip()
-    cleaned = re.sub(r'[ \t]+', ' ', cleaned)
-    cleaned = re.sub(r'\n+', '\n', cleaned)
-    cleaned = re.sub(r'[\x00-\x1f\x7f-\x9f]', '', cleaned)
+    cleaned = stripped.translate(_CONTROL_CHARS)
+    cleaned = _SPACES_RE.sub(' ', cleaned)
+    cleaned = _NEWLINES_RE.sub('\n', cleaned)
+    
+    # One clock read per request; the report shows the same time as extracted_at
+    now = datetime.now()
+    
+    if tool_context:
+        # The cleaned text lives only in state, not in the function response, so
+        # it is not copied into the extractor's reply or the conversation
+        # history. The analysts read it from here; the hash keys the cache.
+        tool_context.state["document_hash"] = hashlib.sha256(cleaned.encode()).hexdigest()
+        tool_context.state["cleaned_text"] = cleaned
+        tool_context.state["analysis_date"] = now.strftime('%Y-%m-%d %H:%M:%S')
+        tool_context.state["extraction_error"] = None
+        _reset_analysis_results(tool_context)
     
     return {
         "status": "success",
         "message": f"Document extracted and cleaned successfully from {source_type.upper()}",
-        "cleaned_text": cleaned,
+        "characters": len(cleaned),
         "source_type": source_type,
-        "extracted_at": datetime.now().isoformat()
+        "extracted_at": now.isoformat()
+    }
+
+
+# ============================================================================
+# ANALYSIS CACHE
+# Identical documents (e.g. a recurring template) reuse the earlier model
+# responses for each analysis agent instead of calling Flash again.
+# ============================================================================
+
+ANALYSIS_CACHE_SIZE = 256
+_analysis_cache: "OrderedDict[Tuple[str, str], str]" = OrderedDict()
+
+
+def _analysis_cache_key(callback_context: CallbackContext) -> Optional[Tuple[str, str]]:
+    """Keys cached responses by agent name and SHA-256 of the cleaned text."""
+    document_hash = callback_context.state.get("document_hash")
+    if not CACHE_ENABLED or not document_hash:
+        return None
+    return (callback_context.agent_name, document_hash)
+
+
+def load_cached_response(callback_context: CallbackContext, llm_request: LlmRequest) -> Optional[LlmResponse]:
+    """Answers from the cache when this agent already analyzed the document."""
+    key = _analysis_cache_key(callback_context)
+    cached = _analysis_cache.get(key) if key else None
+    if cached is None:
+        return None
+    _analysis_cache.move_to_end(key)
+    return LlmResponse(content=types.Content(role="model", parts=[types.Part(text=cached)]))
+
+
+def store_response(callback_context: CallbackContext, llm_response: LlmResponse) -> Optional[LlmResponse]:
+    """Caches the agent's final response text for the current document.
+
+    Only complete answers are kept: a response cut off by max_output_tokens (or
+    any other non-STOP finish) would otherwise be replayed for every rerun.
+    """
+    key = _analysis_cache_key(callback_context)
+    if key is None or llm_response.partial or not llm_response.content:
+        return None
+    # Older ADK releases have no finish_reason on LlmResponse; there the JSON
+    # check below is what keeps truncated answers out of the cache.
+    finish_reason = getattr(llm_response, "finish_reason", types.FinishReason.STOP)
+    if getattr(llm_response, "error_code", None) or finish_reason != types.FinishReason.STOP:
+        return None
+    text = "".join(part.text or "" for part in llm_response.content.parts or [])
+    if parse_json_result(text):
+        _remember(_analysis_cache, key, text, ANALYSIS_CACHE_SIZE)
+    return None
+
+
+# ============================================================================
+# REPORT FORMATTING
+# The report skeleton is filled in here instead of being sent to Flash, so
+# the model only has to produce the small JSON results.
+# ============================================================================
+
+REPORT_TEMPLATE = """## 📄 LEGAL DOCUMENT ANALYSIS REPORT
+---
+
+### 🎯 EXECUTIVE SUMMARY
+* **Risk Level:** {risk_level}
+* **Risk Score:** {risk_score}/10
+* **Analysis Date:** {analysis_date}
+
+### 📋 KEY PARTIES & OBLIGATIONS
+Based on the analysis, the primary parties and their general obligations are:
+
+{parties}
+
+### 💰 FINANCIAL TERMS
+{financial_terms}
+
+### ⚠️  IDENTIFIED RISKS
+{risks}
+
+### 💡 RECOMMENDATIONS
+1.  Based on the risk score of **{risk_score}**, this document is considered **{risk_level} risk**.
+2.  Review the identified risks, especially any missing critical clauses.
+3.  Always have legal counsel review contracts before execution.
+
+---
+> **Disclaimer:** This is an automated analysis. Please consult with legal counsel for professional advice before making any decisions.
+"""
+
+# JSON answers from the analysts are tiny; cap decoding so a runaway response
+# cannot stall the workflow.
+ANALYST_CONFIG = types.GenerateContentConfig(
+    response_mime_type="application/json",
+    max_output_tokens=512,
+)
+
+# The fused analysis returns all three results in one answer.
+COMBINED_ANALYST_CONFIG = types.GenerateContentConfig(
+    response_mime_type="application/json",
+    max_output_tokens=1024,
+)
+
+_JSON_FENCE_RE = re.compile(r'^```(?:json)?\s*|\s*```$')
+
+
+def parse_json_result(value: Any) -> Dict[str, Any]:
+    """Parses an agent's JSON output from state, tolerating Markdown code fences."""
+    if isinstance(value, dict):
+        return value
+    if not isinstance(value, str) or not value.strip():
+        return {}
+    try:
+        parsed = json.loads(_JSON_FENCE_RE.sub('', value.strip()))
+    except json.JSONDecodeError:
+        return {}
+    return parsed if isinstance(parsed, dict) else {}
+
+
+def analyst_instruction(prompt: str):
+    """Builds an instruction that appends the cleaned document from state to the prompt."""
+    def instruction(context: ReadonlyContext) -> str:
+        return f"{prompt}\n\nDOCUMENT:\n{context.state.get('cleaned_text', '')}"
+    return instruction
+
+
+def split_analysis_result(callback_context: CallbackContext) -> Optional[types.Content]:
+    """Fans the fused analysis out into the party, financial and risk result keys."""
+    analysis = parse_json_result(callback_context.state.get("analysis_result"))
+    callback_context.state["party_result"] = {"parties": _as_list(analysis.get("parties"), _PARTY_KEYS)}
+    callback_context.state["financial_result"] = {"financial_terms": _as_list(analysis.get("financial_terms"))}
+    callback_context.state["risk_result"] = {
+        "risks": _as_list(analysis.get("risks"), _RISK_KEYS),
+        "risk_score": analysis.get("risk_score", "N/A"),
+        "risk_level": analysis.get("risk_level", "Unknown"),
     }
+    return None
+
+
+def _as_text(value: Any) -> str:
+    """Renders a JSON value from the analysts as plain text rather than a Python repr."""
+    if isinstance(value, dict):
+        return ", ".join(text for text in map(_as_text, value.values()) if text)
+    if isinstance(value, (list, tuple)):
+        return ", ".join(text for text in map(_as_text, value) if text)
+    return "" if value is None else str(value).strip()
+
+
+# A dict carrying one of these keys is a single party / risk, not a mapping of them
+_PARTY_KEYS = ("name", "obligations")
+_RISK_KEYS = ("description", "severity")
+
+
+def _as_list(value: Any, item_keys: Tuple[str, ...] = ()) -> List[Any]:
+    """Coerces an analyst list field to a list, whatever shape the model returned."""
+    if value is None:
+        return []
+    if isinstance(value, (list, tuple)):
+        return list(value)
+    if isinstance(value, dict):
+        return [value] if any(key in value for key in item_keys) else list(value.values())
+    return [value]
+
+
+def _format_party(party: Any) -> str:
+    """Returns the party's bullet, or "" when there is nothing to show."""
+    if isinstance(party, dict):
+        name = _as_text(party.get("name"))
+        obligations = _as_text(party.get("obligations"))
+        if obligations:
+            return f"* **{name or 'Unknown party'}:** Primary obligations include {obligations}."
+    else:
+        name = _as_text(party)
+    return f"* **{name}**" if name else ""
+
+
+def _risk_description(risk: Any) -> str:
+    return _as_text(risk.get("description")) if isinstance(risk, dict) else _as_text(risk)
+
+
+def _format_risk(index: int, risk: Any) -> str:
+    severity = _as_text(risk.get("severity")) if isinstance(risk, dict) else ""
+    if severity:
+        return f"{index}.  **{_risk_description(risk)}** [{severity} Severity]"
+    return f"{index}.  **{_risk_description(risk)}**"
+
+
+def generate_report(state: Dict[str, Any]) -> str:
+    """Renders the final Markdown report from the party, financial and risk results."""
+    parties = _as_list(parse_json_result(state.get("party_result")).get("parties"), _PARTY_KEYS)
+    financial_terms = _as_list(parse_json_result(state.get("financial_result")).get("financial_terms"))
+    risk_result = parse_json_result(state.get("risk_result"))
+    # Entries with nothing to show are dropped before numbering
+    risks = [risk for risk in _as_list(risk_result.get("risks"), _RISK_KEYS) if _risk_description(risk)]
+    party_lines = [line for line in map(_format_party, parties) if line]
+    financial_lines = [f"* {text}" for text in map(_as_text, financial_terms) if text]
+
+    return REPORT_TEMPLATE.format(
+        risk_level=_as_text(risk_result.get("risk_level")) or "Unknown",
+        risk_score=_as_text(risk_result.get("risk_score")) or "N/A",
+        analysis_date=state.get("analysis_date") or datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+        parties="\n".join(party_lines) or "* No parties identified",
+        financial_terms="\n".join(financial_lines) or "* No financial terms identified",
+        risks="\n".join(_format_risk(i, r) for i, r in enumerate(risks, 1)) or "1.  **No risks identified**",
+    )
+
+
+class ReportGeneratorAgent(BaseAgent):
+    """Assembles the final report in Python, without a model call."""
+
+    async def _run_async_impl(self, ctx: InvocationContext) -> AsyncGenerator[Event, None]:
+        state = ctx.session.state
+        if state.get("cleaned_text"):
+            report = generate_report(state)
+        else:
+            # Nothing was analyzed; show why instead of an empty report
+            report = f"⚠️ {state.get('extraction_error') or 'No document text was extracted. Please provide a valid legal document (text or PDF).'}"
+        yield Event(
+            invocation_id=ctx.invocation_id,
+            author=self.name,
+            branch=ctx.branch,
+            content=types.Content(role="model", parts=[types.Part(text=report)]),
+            actions=EventActions(state_delta={"final_report": report}),
+        )
 
 
 # ============================================================================
 # AGENT DEFINITIONS ("Divide and Conquer" with Flash)
 # ============================================================================
 
-# Agent 1: Document Extractor (Unchanged)
+# Agent 1: Document Extractor
 extractor_agent = Agent(
     name="document_extractor",
     model="gemini-2.0-flash",
@@ -105,156 +430,110 @@ extractor_agent = Agent(
     instruction="""You are a document extraction specialist with PDF processing capabilities.
     1. Check for PDF files or text input.
     2. Call the extract_document_text function.
-    3. Return the extraction result exactly as provided by the function.
+    3. Reply with only the 'status' and 'message' returned by the function. Do NOT repeat the document text.
     4. Do not add any commentary or additional text.""",
     tools=[extract_document_text],
     output_key="extraction_result"
 )
 
-# Agent 2: Party Identifier (UPDATED PROMPT)
+# Agent 2: Combined Analyst (short documents; one call instead of agents 2a-2c)
+combined_analysis_agent = Agent(
+    name="combined_analysis_agent",
+    model="gemini-2.0-flash",
+    description="Identifies parties, financial terms and risks from the document text in one pass",
+    instruction=analyst_instruction("""You are a legal, financial and risk analyst. Using the DOCUMENT below:
+    1. Identify ALL main legal parties of the agreement and each party's primary obligations. Exclude individual signatories unless they are a named party.
+    2. Identify the key financial terms, like total contract value and payment schedule.
+    3. Check for the critical clauses: Limitation of Liability, Indemnification, Dispute Resolution, Termination, Confidentiality.
+    4. Score the risk 0-10 with a level of Low, Medium or High (missing Limitation of Liability ~8; all standard clauses present ~2) and list the top 2-3 risks.
+    Return ONLY JSON like: {"parties": [{"name": "CloudTech Solutions Inc.", "obligations": "providing services"}], "financial_terms": ["Total fee of $450,000"], "risks": [{"severity": "Medium", "description": "Termination for convenience requires a 60-day notice."}], "risk_score": 3, "risk_level": "Low"}"""),
+    include_contents="none",
+    generate_content_config=COMBINED_ANALYST_CONFIG,
+    output_key="analysis_result",
+    before_model_callback=load_cached_response,
+    after_model_callback=store_response,
+    after_agent_callback=split_analysis_result
+)
+
+# Agent 2a: Party Identifier
 party_agent = Agent(
     name="party_identifier_agent",
     model="gemini-2.0-flash",
     description="Identifies the main parties from the document text",
-    instruction="""You are a legal analyst. You will receive an 'extraction_result'.
-    Look at the 'extraction_result.cleaned_text'.
-    Identify ALL main legal parties of the agreement (e.g., "CloudTech Solutions Inc.", "Global Retail Enterprises LLC", "Jessica Williams").
-    Do NOT include individual signatory names *unless* they are a named party (like in a partnership agreement).
-    
-    You MUST return ONLY a valid JSON object in this format:
-    {"parties": ["Full Party Name 1", "Full Party Name 2", "...etc"]}
-    """,
-    output_key="party_result"
+    instruction=analyst_instruction("""You are a legal analyst. Using the DOCUMENT below, identify ALL main legal parties of the agreement and each party's primary obligations.
+    Exclude individual signatories unless they are a named party (e.g., in a partnership agreement).
+    Return ONLY JSON like: {"parties": [{"name": "CloudTech Solutions Inc.", "obligations": "providing services and maintaining confidentiality"}]}"""),
+    include_contents="none",
+    generate_content_config=ANALYST_CONFIG,
+    output_key="party_result",
+    before_model_callback=load_cached_response,
+    after_model_callback=store_response
 )
 
-# Agent 3: Financial Analyst (Unchanged)
+# Agent 2b: Financial Analyst
 financial_agent = Agent(
     name="financial_agent",
     model="gemini-2.0-flash",
     description="Identifies key financial terms from the document text",
-    instruction="""You are a financial analyst. You will receive an 'extraction_result'.
-    Look at the 'extraction_result.cleaned_text'.
-    Identify the key financial terms, like total contract value and payment schedule.
-    
-    You MUST return ONLY a valid JSON object in this format:
-    {"financial_terms": ["Total fee of $450,000", "$90,000 Initial Deposit", "Payment due 15 business days of invoice"]}
-    """,
-    output_key="financial_result"
+    instruction=analyst_instruction("""You are a financial analyst. Using the DOCUMENT below, identify the key financial terms, like total contract value and payment schedule.
+    Return ONLY JSON like: {"financial_terms": ["Total fee of $450,000", "$90,000 Initial Deposit", "Payment due 15 business days of invoice"]}"""),
+    include_contents="none",
+    generate_content_config=ANALYST_CONFIG,
+    output_key="financial_result",
+    before_model_callback=load_cached_response,
+    after_model_callback=store_response
 )
 
-# Agent 4: Risk Analyst 
+# Agent 2c: Risk Analyst
 risk_agent = Agent(
     name="risk_analyst_agent",
     model="gemini-2.0-flash",
     description="Identifies risks and missing clauses from the text",
-    instruction="""You are a risk analyst. You will receive an 'extraction_result'.
-    Look at the 'extraction_result.cleaned_text'.
-    1. Identify any present or missing critical clauses: "Limitation of Liability", "Indemnification", "Dispute Resolution", "Termination", "Confidentiality".
-    2. Assign a risk score (0-10) and level (Low, Medium, High). A missing 'Limitation of Liability' is a high risk (e.g., 8/10). A standard doc with all clauses is low (e.g., 2/10).
+    instruction=analyst_instruction("""You are a risk analyst. Using the DOCUMENT below:
+    1. Check for the critical clauses: Limitation of Liability, Indemnification, Dispute Resolution, Termination, Confidentiality.
+    2. Score the risk 0-10 with a level of Low, Medium or High (missing Limitation of Liability ~8; all standard clauses present ~2).
     3. List the top 2-3 risks.
-    
-    You MUST return ONLY a valid JSON object in this format:
-    {
-      "risks": [
-        {"severity": "Low", "description": "Document includes standard clauses (Liability, Indemnification, etc.)"},
-        {"severity": "Medium", "description": "Termination for convenience clause requires a long 60-day notice."}
-      ],
-      "risk_score": 3,
-      "risk_level": "Low"
-    }
-    """,
-    output_key="risk_result"
+    Return ONLY JSON like: {"risks": [{"severity": "Medium", "description": "Termination for convenience requires a 60-day notice."}], "risk_score": 3, "risk_level": "Low"}"""),
+    include_contents="none",
+    generate_content_config=ANALYST_CONFIG,
+    output_key="risk_result",
+    before_model_callback=load_cached_response,
+    after_model_callback=store_response
 )
 
-# Agent 5: Report Generator (UPDATED with Markdown)
-report_generator_agent = Agent(
+# Agent 3: Report Generator (fills REPORT_TEMPLATE in Python)
+report_generator_agent = ReportGeneratorAgent(
     name="report_generator_agent",
-    model="gemini-2.0-flash",
-    description="Generates the final report by combining all analysis parts",
-    instruction=f"""You are a final report generator. You will receive several JSON inputs: 'party_result', 'financial_result', and 'risk_result'.
-    Your job is to assemble these pieces into a single, comprehensive **Markdown** report for the user.
-    Do NOT make up new information. Only use the data provided in the inputs.
-    Use headings (`##`), bolding (`**...**`), and bullet points (`*`) for clarity.
-    
-    You MUST format your *entire* response as the final report. Do not add any other text or JSON.
-
-## 📄 LEGAL DOCUMENT ANALYSIS REPORT
----
-
-### 🎯 EXECUTIVE SUMMARY
-* **Risk Level:** [Get from risk_result.risk_level]
-* **Risk Score:** [Get from risk_result.risk_score]/10
-* **Analysis Date:** {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}
-
-### 📋 KEY PARTIES & OBLIGATIONS
-Based on the analysis, the primary parties and their general obligations are:
-
-[Loop through party_result.parties]
-* **[Party Name]:** Primary obligations include [e.g., "providing services" or "making payments"] and maintaining confidentiality.
-
-### 💰 FINANCIAL TERMS
-[List each item from financial_result.financial_terms as a bullet point]
-* [Item 1]
-* [Item 2]
-
-### ⚠️  IDENTIFIED RISKS
-[List each risk from risk_result.risks as a numbered item]
-1.  **[risk.description]** [[risk.severity] Severity]
-
-### 💡 RECOMMENDATIONS
-1.  Based on the risk score of **[risk_result.risk_score]**, this document is considered **[risk_result.risk_level] risk**.
-2.  Review the identified risks, especially any missing critical clauses.
-3.  Always have legal counsel review contracts before execution.
-
----
-> **Disclaimer:** This is an automated analysis. Please consult with legal counsel for professional advice before making any decisions.
-""",
-    output_key="final_report"
+    description="Generates the final report by combining all analysis parts"
 )
 
 
-# Agent 6: Contract Comparison Agent (UPDATED with Markdown)
+# Agent 4: Contract Comparison Agent (UPDATED with Markdown)
 comparison_agent = Agent(
     name="contract_comparison_agent",
     model="gemini-2.0-flash",
     description="Compares two legal documents side-by-side (Flash version)",
-    instruction="""You are a contract comparison specialist. 
-
-When a user provides TWO contracts to compare in this format:
-   "Compare these contracts:
-   
-   CONTRACT A:
-   [first contract text]
-   
-   CONTRACT B:
-   [second contract text]"
-
-You MUST:
-1.  Parse the text for 'CONTRACT A' and 'CONTRACT B'.
-2.  Perform a **high-level, brief** analysis.
-3.  Generate a simple **Markdown** report using headings, tables, and bolding.
-
-**OUTPUT FORMAT (CRITICAL):**
-You MUST format your *entire* response as the final report. Do not add any other text.
+    instruction="""You are a contract comparison specialist. The user sends two contracts marked 'CONTRACT A:' and 'CONTRACT B:'.
+Do a brief, high-level comparison and respond ONLY with this Markdown report, filling in the brackets:
 
 ## 🔄 CONTRACT COMPARISON REPORT (Flash Analysis)
 ---
 
 ### 📊 HIGH-LEVEL COMPARISON
 
-| Metric          | Document A                     | Document B                     |
-|:----------------|:-------------------------------|:-------------------------------|
+| Metric | Document A | Document B |
+|:--|:--|:--|
 | **Est. Risk** | **[Score A]/10 ([Level A])** | **[Score B]/10 ([Level B])** |
-| Est. Value      | [Value A, or "Not specified"]  | [Value B, or "Not specified"]  |
+| Est. Value | [Value A or "Not specified"] | [Value B or "Not specified"] |
 
 ### ⚖️  KEY OBSERVATIONS
-* [Brief note on risk. e.g., "Doc A seems lower risk as it includes a Liability clause."]
-* [Brief note on clauses. e.g., "Both docs contain Confidentiality clauses."]
-* [Brief note on financials. e.g., "Doc B has a higher contract value."]
+* [Note on risk]
+* [Note on clauses]
+* [Note on financials]
 
 ### 💡 RECOMMENDATION
-1.  Based on this brief analysis, **[e.g., "Document A appears more favorable"]**.
-2.  Please review [e.g., "the missing clauses in Document B"].
+1.  [Which document appears more favorable]
+2.  Please review [the main concern].
 3.  Always consult with legal counsel for a full professional review.
 
 ---
@@ -263,35 +542,66 @@ You MUST format your *entire* response as the final report. Do not add any other
 )
 
 # ============================================================================
-# NEW AGENT: FINAL RESPONDER
-# This agent's only job is to "unpack" the report from the workflow state.
+# SEQUENTIAL WORKFLOW 
 # ============================================================================
-final_responder_agent = Agent(
-    name="final_responder_agent",
-    model="gemini-2.0-flash",
-    description="Presents the final formatted report string to the user",
-    instruction="""You will be given a pre-formatted string. 
-    This string is the final report.
-    You MUST output this string EXACTLY as you receive it.
-    Do not add any text, commentary, or formatting.
-    Just repeat the string.""",
-    output_key="final_formatted_report"
-)
 
+# Agents 2a-2c only read the extracted text and write separate output keys,
+# so they run concurrently instead of one after another.
+parallel_analysis_agent = ParallelAgent(
+    name="parallel_analysis_agent",
+    description="Runs the party, financial and risk analysts concurrently on the extracted text",
+    sub_agents=[
+        party_agent,
+        financial_agent,
+        risk_agent
+    ]
+)
 
-# ============================================================================
-# SEQUENTIAL WORKFLOW 
-# ============================================================================
+# Documents up to this size go through the single fused call, so the text is
+# sent to the model once. Longer contracts produce longer answers, so they are
+# split across the parallel analysts to keep decoding time down.
+FUSED_ANALYSIS_MAX_CHARS = 30_000
+
+
+class AnalysisRouterAgent(BaseAgent):
+    """Picks the fused or the parallel analysis based on the document length."""
+
+    fused_agent: BaseAgent
+    parallel_agent: BaseAgent
+
+    def __init__(self, name: str, fused_agent: BaseAgent, parallel_agent: BaseAgent, **kwargs):
+        super().__init__(
+            name=name,
+            fused_agent=fused_agent,
+            parallel_agent=parallel_agent,
+            sub_agents=[fused_agent, parallel_agent],
+            **kwargs,
+        )
+
+    async def _run_async_impl(self, ctx: InvocationContext) -> AsyncGenerator[Event, None]:
+        document_length = len(ctx.session.state.get("cleaned_text") or "")
+        if not document_length:
+            # Extraction failed; the report generator shows the error instead
+            return
+        agent = self.fused_agent if document_length <= FUSED_ANALYSIS_MAX_CHARS else self.parallel_agent
+        async for event in agent.run_async(ctx):
+            yield event
+
+
+analysis_router_agent = AnalysisRouterAgent(
+    name="analysis_router_agent",
+    description="Analyzes parties, financial terms and risks with one call for short documents or three parallel calls for long ones",
+    fused_agent=combined_analysis_agent,
+    parallel_agent=parallel_analysis_agent
+)
 
 legal_analysis_workflow = SequentialAgent(
     name="legal_analysis_workflow",
     description="Sequential workflow for analyzing legal documents using a 'divide and conquer' flash-model approach.",
     sub_agents=[
         extractor_agent,
-        party_agent,
-        financial_agent,
-        risk_agent,
-        report_generator_agent  # This is the 5th and final step of the workflow
+        analysis_router_agent,
+        report_generator_agent  # Runs once all three analyses are in state
     ]
     # The output of this workflow will be a dict containing "final_report"
 )
@@ -308,11 +618,9 @@ root_agent = Agent(
     instruction="""You are a professional Legal Document Analyzer assistant.
 
 SINGLE DOCUMENT ANALYSIS:
-1.  First, transfer to the `legal_analysis_workflow`. This workflow will run 5 steps and return a state dictionary.
-2.  This dictionary will contain a key named `final_report`, which holds the fully formatted Markdown report as a string.
-3.  Next, transfer to the `final_responder_agent`.
-4.  Pass the `final_report` string (which you get from the workflow's output) to the `final_responder_agent`.
-5.  This agent will then present the clean, formatted report to the user.
+- Transfer to the `legal_analysis_workflow`. This workflow extracts, analyzes and reports on the document.
+- Its last step presents the formatted Markdown report (stored as `final_report`) to the user directly.
+- Do not repeat, summarize, or add to the report.
 
 COMPARING TWO DOCUMENTS:
 When a user wants to compare TWO contracts:
@@ -332,8 +640,7 @@ Always be professional, accurate, and helpful.
 """,
     sub_agents=[
         legal_analysis_workflow, 
-        comparison_agent,
-        final_responder_agent  # Added the final responder
+        comparison_agent
     ]
 )
 